@@ -1,17 +1,84 @@
-import discord
-from discord.ext import commands
-import yt_dlp
 import asyncio
+import base64
+import json
 import os
 import re
+import threading
+import time
+import traceback
+import unicodedata
+from urllib.parse import parse_qs, urlparse
 from dotenv import load_dotenv
-from collections import deque
+from collections import OrderedDict, deque
+
+# Only what the gateway needs is imported at startup, yt-dlp is loaded lazily
+STARTUP_TIME = time.perf_counter()
+import aiohttp
+import discord
+from discord.ext import commands
+GATEWAY_IMPORT_TIME = time.perf_counter() - STARTUP_TIME
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 SPOTIFY_CLIENT_ID = os.getenv('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.getenv('SPOTIFY_CLIENT_SECRET')
 
+# Set PROFILE_IMPORTS=1 to print how long heavy imports take
+# (for a per-module breakdown run: python -X importtime main.py)
+PROFILE_IMPORTS = os.getenv('PROFILE_IMPORTS', '0') == '1'
+# Video used to warm up yt-dlp after on_ready (empty value disables warm-up)
+YTDLP_WARMUP_URL = os.getenv('YTDLP_WARMUP_URL', 'https://www.youtube.com/watch?v=jNQXAC9IVRw')
+
+# Search cache: normalized text query -> chosen YouTube video
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', str(7 * 24 * 3600)))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '1000'))
+SEARCH_CACHE_FILE = os.getenv('SEARCH_CACHE_FILE', '')
+# How often (seconds) changed search cache is written to SEARCH_CACHE_FILE
+SEARCH_CACHE_FLUSH_INTERVAL = int(os.getenv('SEARCH_CACHE_FLUSH_INTERVAL', '60'))
+
+# Stream URL cache: entries are served only while the whole track plus this many seconds
+# fits before googlevideo expiry (FFmpeg reconnects to the same URL during playback)
+STREAM_CACHE_MARGIN = int(os.getenv('STREAM_CACHE_MARGIN', '120'))
+# Lifetime used when the stream URL has no expire parameter
+STREAM_CACHE_DEFAULT_TTL = int(os.getenv('STREAM_CACHE_DEFAULT_TTL', '1800'))
+
+# Start FFmpeg for the next track PRESPAWN_SECONDS of playback before the current one ends,
+# its stream URL is resolved earlier, PRESPAWN_RESOLVE_SECONDS before the end
+PRESPAWN_FFMPEG = os.getenv('PRESPAWN_FFMPEG', '0') == '1'
+PRESPAWN_SECONDS = int(os.getenv('PRESPAWN_SECONDS', '5'))
+PRESPAWN_RESOLVE_SECONDS = int(os.getenv('PRESPAWN_RESOLVE_SECONDS', '60'))
+# Max number of idle pre-spawned FFmpeg processes across all guilds
+PRESPAWN_MAX = int(os.getenv('PRESPAWN_MAX', '4'))
+
+# Resource accounting and adaptive voice quality
+ADAPTIVE_QUALITY = os.getenv('ADAPTIVE_QUALITY', '1') == '1'
+RESOURCE_SAMPLE_INTERVAL = int(os.getenv('RESOURCE_SAMPLE_INTERVAL', '5'))
+# Opus bitrates (kbps) to step through when frames start arriving late
+VOICE_BITRATES = [int(b) for b in os.getenv('VOICE_BITRATES', '128,96,64,48').split(',')]
+# 95th percentile frame lateness (ms) over a sample window that lowers guild bitrate / refuses new voice sessions
+LATENESS_DEGRADE_MS = int(os.getenv('LATENESS_DEGRADE_MS', '40'))
+LATENESS_REFUSE_MS = int(os.getenv('LATENESS_REFUSE_MS', '200'))
+
+# Batch enqueue: max links taken from one message and how many resolve at once
+BATCH_MAX_LINKS = int(os.getenv('BATCH_MAX_LINKS', '25'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+
+if PROFILE_IMPORTS:
+    print(f'⏱️ import discord, aiohttp: {GATEWAY_IMPORT_TIME * 1000:.1f} ms')
+
+_yt_dlp = None
+
+def get_yt_dlp():
+    """Import yt-dlp on first use (loads hundreds of extractor modules)"""
+    global _yt_dlp
+    if _yt_dlp is None:
+        start = time.perf_counter()
+        import yt_dlp
+        _yt_dlp = yt_dlp
+        if PROFILE_IMPORTS:
+            print(f'⏱️ import yt_dlp: {(time.perf_counter() - start) * 1000:.1f} ms')
+    return _yt_dlp
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
@@ -72,19 +139,21 @@ SPOTIFY_ALBUM_PATTERNS = [
 
 SPOTIFY_PATTERNS = SPOTIFY_TRACK_PATTERNS + SPOTIFY_PLAYLIST_PATTERNS + SPOTIFY_ALBUM_PATTERNS
 
-def find_music_link(message):
-    """Search for YouTube or Spotify link in message"""
-    for pattern in YOUTUBE_PATTERNS:
-        match = re.search(pattern, message)
-        if match:
-            return match.group(0)
+MUSIC_LINK_RE = re.compile('|'.join(YOUTUBE_PATTERNS + SPOTIFY_PATTERNS))
 
-    for pattern in SPOTIFY_PATTERNS:
-        match = re.search(pattern, message)
-        if match:
-            return match.group(0)
+def find_music_links(message):
+    """Find all YouTube and Spotify links in message, in order, without duplicates.
+    A message that is a single link is returned whole, with its full query string
+    (e.g. watch?v=...&list=... keeps the playlist)."""
+    text = message.strip()
+    if text.startswith('http') and len(text.split()) == 1:
+        return [text] if MUSIC_LINK_RE.match(text) else []
 
-    return None
+    links = []
+    for match in MUSIC_LINK_RE.finditer(message):
+        if match.group(0) not in links:
+            links.append(match.group(0))
+    return links
 
 def is_spotify_link(url):
     for pattern in SPOTIFY_PATTERNS:
@@ -109,8 +178,6 @@ spotify_token_cache = {'token': None, 'expires_at': 0}
 
 async def get_spotify_token():
     """Get Spotify API access token"""
-    import time
-
     if spotify_token_cache['token'] and time.time() < spotify_token_cache['expires_at']:
         return spotify_token_cache['token']
 
@@ -118,9 +185,6 @@ async def get_spotify_token():
         print('⚠️ Spotify API credentials not configured')
         return None
 
-    import aiohttp
-    import base64
-
     auth_str = f'{SPOTIFY_CLIENT_ID}:{SPOTIFY_CLIENT_SECRET}'
     auth_bytes = auth_str.encode('ascii')
     auth_base64 = base64.b64encode(auth_bytes).decode('ascii')
@@ -138,7 +202,6 @@ async def get_spotify_token():
                     token = data.get('access_token')
                     expires_in = data.get('expires_in', 3600)
 
-                    import time
                     spotify_token_cache['token'] = token
                     spotify_token_cache['expires_at'] = time.time() + expires_in - 60
 
@@ -158,8 +221,6 @@ async def get_spotify_track_info(track_id):
     if not token:
         return None
 
-    import aiohttp
-
     async with aiohttp.ClientSession() as session:
         try:
             async with session.get(
@@ -194,8 +255,6 @@ async def get_spotify_album_tracks(album_id):
     if not token:
         return None
 
-    import aiohttp
-
     async with aiohttp.ClientSession() as session:
         try:
             url = f'https://api.spotify.com/v1/albums/{album_id}'
@@ -235,7 +294,6 @@ async def get_spotify_album_tracks(album_id):
                     return None
         except Exception as e:
             print(f'❌ Album fetch error: {e}')
-            import traceback
             traceback.print_exc()
             return None
 
@@ -246,8 +304,6 @@ async def get_spotify_playlist_tracks(playlist_id):
     if not token:
         return None
 
-    import aiohttp
-
     all_tracks = []
     offset = 0
     limit = 100
@@ -319,7 +375,6 @@ async def get_spotify_playlist_tracks(playlist_id):
                         break
             except Exception as e:
                 print(f'❌ Playlist fetch error: {e}')
-                import traceback
                 traceback.print_exc()
                 break
 
@@ -346,8 +401,6 @@ async def convert_spotify_to_youtube(spotify_url):
                 print('⚠️ Spotify API failed, trying oembed...')
 
             # Fallback: oembed API
-            import aiohttp
-
             async with aiohttp.ClientSession() as session:
                 clean_url = f'https://open.spotify.com/track/{track_id}'
                 oembed_url = f'https://open.spotify.com/oembed?url={clean_url}'
@@ -379,7 +432,7 @@ async def extract_info_async(url, ydl_options):
 
     def _extract():
         try:
-            with yt_dlp.YoutubeDL(ydl_options) as ydl:
+            with get_yt_dlp().YoutubeDL(ydl_options) as ydl:
                 return ydl.extract_info(url, download=False)
         except Exception as e:
             print(f'❌ Error in _extract: {e}')
@@ -394,6 +447,359 @@ async def extract_info_async(url, ydl_options):
         print('⏱️ Timeout getting info from yt-dlp')
         raise Exception('Timeout searching video')
 
+# Background tasks started after first on_ready (references keep them from being garbage-collected)
+warmup_task = None
+monitor_task = None
+search_cache_task = None
+
+async def warm_up_extractor():
+    """Load yt-dlp and fill its extractor and JS player caches in background"""
+    if not YTDLP_WARMUP_URL:
+        return
+
+    start = time.perf_counter()
+    try:
+        await extract_info_async(YTDLP_WARMUP_URL, YDL_OPTIONS)
+        print(f'🔥 yt-dlp warmed up in {time.perf_counter() - start:.1f}s')
+    except Exception as e:
+        print(f'⚠️ yt-dlp warm-up failed: {e}')
+
+def normalize_query(query):
+    """Normalize search query so casing, spacing and punctuation don't matter"""
+    query = unicodedata.normalize('NFKC', query).casefold()
+    query = re.sub(r'[^\w\s]|_', ' ', query)
+    return ' '.join(query.split())
+
+class SearchCache:
+    """LRU cache of search results with TTL and optional JSON persistence"""
+
+    def __init__(self, ttl, max_size, path=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.dirty = False
+
+    def get(self, query):
+        key = normalize_query(query)
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        if time.time() - entry['cached_at'] > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, query, video):
+        key = normalize_query(query)
+        video_id = video.get('id')
+        if not key or not video_id:
+            return
+        self.entries[key] = {
+            'id': video_id,
+            'title': video.get('title', 'Unknown song'),
+            'webpage_url': video.get('webpage_url') or f'https://www.youtube.com/watch?v={video_id}',
+            'duration': video.get('duration'),
+            'cached_at': time.time(),
+        }
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f'⚠️ Failed to load search cache: {e}')
+            return
+        if not isinstance(data, dict):
+            print('⚠️ Search cache file has unexpected format, ignoring it')
+            return
+
+        now = time.time()
+        loaded = []
+        for key, entry in data.items():
+            if not isinstance(entry, dict) or not isinstance(entry.get('id'), str):
+                continue
+            cached_at = entry.get('cached_at')
+            if not isinstance(cached_at, (int, float)) or now - cached_at > self.ttl:
+                continue
+            video_id = entry['id']
+            loaded.append((key, {
+                'id': video_id,
+                'title': str(entry.get('title') or 'Unknown song'),
+                'webpage_url': str(entry.get('webpage_url') or f'https://www.youtube.com/watch?v={video_id}'),
+                'duration': entry.get('duration'),
+                'cached_at': cached_at,
+            }))
+
+        for key, entry in sorted(loaded, key=lambda item: item[1]['cached_at']):
+            self.entries[key] = entry
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        print(f'📦 Loaded {len(self.entries)} cached searches')
+
+    def save(self, snapshot=None):
+        """Write cache to disk (blocking, run it in executor from the event loop).
+        Returns True if the file was written."""
+        if not self.path:
+            return False
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot if snapshot is not None else self.entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            return True
+        except OSError as e:
+            print(f'⚠️ Failed to save search cache: {e}')
+            return False
+
+    async def flush(self):
+        """Save cache in background thread if it changed since last save"""
+        if not self.path or not self.dirty:
+            return
+        # Cleared before writing, so entries added during the write mark it dirty again
+        self.dirty = False
+        snapshot = dict(self.entries)
+        saved = await asyncio.get_event_loop().run_in_executor(None, self.save, snapshot)
+        if not saved:
+            self.dirty = True
+
+search_cache = SearchCache(SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE, SEARCH_CACHE_FILE or None)
+search_cache.load()
+
+async def flush_search_cache():
+    """Periodically persist search cache, so misses don't write the file each time"""
+    while True:
+        await asyncio.sleep(SEARCH_CACHE_FLUSH_INTERVAL)
+        await search_cache.flush()
+
+# Direct stream URLs shared by all guilds: video id -> stream info
+stream_cache = {}
+# In-flight extractions, so concurrent requests for one video share a single yt-dlp call
+stream_requests = {}
+
+YOUTUBE_ID_PATTERN = r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/)([\w-]{11})'
+
+def get_video_id(url):
+    """Extract YouTube video id from URL"""
+    match = re.search(YOUTUBE_ID_PATTERN, url)
+    return match.group(1) if match else None
+
+def parse_stream_expiry(stream_url):
+    """Get expiry timestamp of googlevideo stream URL"""
+    expire = parse_qs(urlparse(stream_url).query).get('expire')
+    if not expire:
+        match = re.search(r'/expire/(\d+)', stream_url)
+        expire = [match.group(1)] if match else None
+    try:
+        return int(expire[0])
+    except (TypeError, ValueError):
+        return int(time.time()) + STREAM_CACHE_DEFAULT_TTL
+
+def stream_entry_usable(entry, now):
+    """Check that cached stream URL stays valid until the track finishes playing"""
+    return entry['expires_at'] - STREAM_CACHE_MARGIN - (entry.get('duration') or 0) > now
+
+def purge_stream_cache():
+    """Drop stream URLs that would expire before their track could finish"""
+    now = time.time()
+    for video_id in [vid for vid, entry in stream_cache.items() if not stream_entry_usable(entry, now)]:
+        del stream_cache[video_id]
+
+def cache_stream_info(info):
+    """Remember direct stream URL of extracted YouTube video"""
+    if not info or info.get('extractor_key') != 'Youtube':
+        return None
+    video_id = info.get('id')
+    stream_url = info.get('url')
+    if not video_id or not stream_url or not stream_url.startswith('http'):
+        return None
+
+    purge_stream_cache()
+    entry = {
+        'id': video_id,
+        'url': stream_url,
+        'http_headers': dict(info.get('http_headers') or {}),
+        'title': info.get('title', 'Unknown song'),
+        'webpage_url': info.get('webpage_url') or f'https://www.youtube.com/watch?v={video_id}',
+        'duration': info.get('duration'),
+        'expires_at': parse_stream_expiry(stream_url),
+    }
+    stream_cache[video_id] = entry
+    return entry
+
+async def resolve_stream(url, video_id=None):
+    """Get stream info for video, reusing cached or in-flight extraction"""
+    video_id = video_id or get_video_id(url)
+    if not video_id:
+        return await extract_info_async(url, YDL_OPTIONS)
+
+    entry = stream_cache.get(video_id)
+    if entry and stream_entry_usable(entry, time.time()):
+        print(f'⚡ Stream cache hit: {video_id}')
+        return entry
+    stream_cache.pop(video_id, None)
+
+    request = stream_requests.get(video_id)
+    if request is None:
+        async def _resolve():
+            info = await extract_info_async(url, YDL_OPTIONS)
+            return cache_stream_info(info) or info
+
+        request = asyncio.ensure_future(_resolve())
+        stream_requests[video_id] = request
+        request.add_done_callback(lambda _: stream_requests.pop(video_id, None))
+    else:
+        print(f'🔗 Joining in-flight extraction: {video_id}')
+
+    # Shield so one cancelled waiter doesn't cancel extraction for the others
+    return await asyncio.shield(request)
+
+async def search_youtube(query):
+    """Search YouTube for free-text query and remember the first result"""
+    info = await extract_info_async(f'ytsearch:{query}', YDL_OPTIONS)
+    entries = [entry for entry in (info or {}).get('entries') or [] if entry]
+    if not entries:
+        return None
+    video = entries[0]
+    search_cache.put(query, video)
+    cache_stream_info(video)
+    return video
+
+async def search_song(query):
+    """Find queue entry for free-text query, skipping YouTube search on cache hit"""
+    cached = search_cache.get(query)
+    if cached:
+        print(f'📦 Search cache hit: {query} -> {cached["id"]}')
+        return {'url': cached['webpage_url'], 'title': cached['title']}
+
+    video = await search_youtube(query)
+    if not video:
+        return None
+    return {
+        'url': video.get('webpage_url') or f'https://www.youtube.com/watch?v={video["id"]}',
+        'title': video.get('title', query),
+    }
+
+def playlist_songs(info):
+    """Turn yt-dlp playlist entries into queue entries"""
+    songs = []
+    for entry in info['entries']:
+        if not entry:
+            continue
+        cached = cache_stream_info(entry)
+        if cached:
+            songs.append({'url': cached['webpage_url'], 'title': cached['title']})
+        else:
+            songs.append({'url': entry['url']})
+    return songs
+
+SPOTIFY_PLAYLIST_MESSAGE = '⚠️ **Spotify playlists not supported due to API limitations.**\n\n💡 But you can:\n• Use Spotify **albums** (they work!)\n• Add individual **tracks** from Spotify\n• Use YouTube playlists'
+
+async def resolve_link(link, notify=None):
+    """Resolve one YouTube or Spotify link to queue entries.
+    notify(text) is awaited with progress and error messages (single-link !play)."""
+    async def _notify(text):
+        if notify:
+            await notify(text)
+
+    if is_spotify_link(link):
+        # Spotify albums
+        if is_spotify_album(link):
+            await _notify('💿 Spotify album detected, loading tracks...')
+
+            album_match = re.search(r'album/([a-zA-Z0-9]+)', link)
+            if not album_match:
+                await _notify('❌ Failed to extract album ID!')
+                return []
+
+            tracks = await get_spotify_album_tracks(album_match.group(1))
+            if not tracks:
+                await _notify('❌ Failed to get album tracks!')
+                return []
+
+            await _notify(f'✅ Found **{len(tracks)}** tracks. Adding to queue...')
+            return [{'search': track} for track in tracks]
+
+        # Spotify playlists (not supported)
+        if is_spotify_playlist(link):
+            print(f'⚠️ Spotify playlists not supported: {link}')
+            await _notify(SPOTIFY_PLAYLIST_MESSAGE)
+            return []
+
+        # Spotify tracks
+        await _notify('🎧 Spotify link detected, converting to YouTube...')
+        search_query = await convert_spotify_to_youtube(link)
+        if not search_query:
+            await _notify('❌ Failed to get info from Spotify!')
+            return []
+
+        await _notify(f'🔍 Searching on YouTube: **{search_query}**...')
+        song = await search_song(search_query)
+        if not song:
+            await _notify('❌ Nothing found on YouTube!')
+            return []
+        return [song]
+
+    # YouTube (and other yt-dlp supported) links
+    await _notify(f'🔍 Searching: **{link}**...')
+    # Video links with a list parameter go to yt-dlp whole, so the playlist is queued
+    if get_video_id(link) and 'list' not in parse_qs(urlparse(link).query):
+        info = await resolve_stream(link)
+    else:
+        info = await extract_info_async(link, YDL_OPTIONS)
+
+    if not info:
+        await _notify('❌ Nothing found!')
+        return []
+
+    # YouTube playlists
+    if 'entries' in info:
+        await _notify(f'📝 Adding playlist: **{info.get("title", "Playlist")}** ({len(info["entries"])} songs)')
+        return playlist_songs(info)
+    return [{'url': info.get('webpage_url') or link, 'title': info.get('title', link)}]
+
+async def enqueue_batch(ctx, queue, links):
+    """Resolve several links with bounded parallelism and queue them in order"""
+    note = ''
+    if len(links) > BATCH_MAX_LINKS:
+        note = f'\n⚠️ Too many links, only first **{BATCH_MAX_LINKS}** of {len(links)} are added'
+        links = links[:BATCH_MAX_LINKS]
+
+    status = await ctx.send(f'🔍 Processing **{len(links)}** links...{note}', silent=True)
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def _resolve(link):
+        async with semaphore:
+            try:
+                return await resolve_link(link)
+            except Exception as e:
+                print(f'❌ Batch link error ({link}): {e}')
+                return []
+
+    results = await asyncio.gather(*[_resolve(link) for link in links])
+
+    added = 0
+    for songs in results:
+        for song in songs:
+            queue.add(song)
+        added += len(songs)
+
+    failed = sum(1 for songs in results if not songs)
+    message = f'✅ Added **{added}** songs from **{len(links) - failed}/{len(links)}** links'
+    if failed:
+        message += f' (❌ {failed} failed)'
+    await status.edit(content=message + note)
+
+    if added and not ctx.guild.voice_client.is_playing():
+        await play_next(ctx)
+
 # Music queue for each server
 music_queues = {}
 now_playing = {}
@@ -427,11 +833,343 @@ def get_queue(guild_id):
         music_queues[guild_id] = MusicQueue()
     return music_queues[guild_id]
 
+async def resolve_song(song):
+    """Get stream info for queued song"""
+    if 'url' in song:
+        return await resolve_stream(song['url'])
+
+    cached = search_cache.get(song['search'])
+    if cached:
+        return await resolve_stream(cached['webpage_url'], cached['id'])
+    return await search_youtube(song['search'])
+
+def create_source(info):
+    """Spawn FFmpeg reading the direct stream URL"""
+    ffmpeg_before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+
+    http_headers = info.get('http_headers', {})
+    if http_headers:
+        user_agent = http_headers.get('User-Agent', '')
+        if user_agent:
+            ffmpeg_before_options += f' -user_agent "{user_agent}"'
+
+    ffmpeg_before_options += ' -headers "Referer: https://www.youtube.com/"'
+
+    print(f'🔧 FFmpeg options: {ffmpeg_before_options}')
+
+    return discord.FFmpegPCMAudio(
+        info['url'],
+        executable=FFMPEG_PATH,
+        before_options=ffmpeg_before_options + ' -analyzeduration 0 -probesize 32',
+        options='-vn -f s16le -ar 48000 -ac 2 -bufsize 512k'
+    )
+
+# Pre-spawned FFmpeg for the next track: guild_id -> {'song', 'info', 'source'}
+prespawned = {}
+prespawn_tasks = {}
+
+def discard_prespawned(guild_id):
+    """Cancel pending pre-spawn and kill idle pre-spawned FFmpeg for guild"""
+    task = prespawn_tasks.pop(guild_id, None)
+    if task:
+        task.cancel()
+
+    entry = prespawned.pop(guild_id, None)
+    if entry:
+        entry['source'].cleanup()
+        print(f'🧹 Discarded pre-spawned FFmpeg: {entry["info"].get("title")}')
+
+def take_prespawned(guild_id, song):
+    """Return pre-spawned entry if it was started for this song"""
+    entry = prespawned.get(guild_id)
+    if entry and entry['song'] is song:
+        del prespawned[guild_id]
+    else:
+        entry = None
+    discard_prespawned(guild_id)
+    return entry
+
+def peek_next_song(queue):
+    """Song that play_next will pick after the current one"""
+    if queue.loop and queue.current:
+        return queue.current
+    if queue.queue:
+        return queue.queue[0]
+    return None
+
+async def wait_until_remaining(source, duration, seconds):
+    """Sleep until at most `seconds` of the track are left, counting played frames.
+    Returns False if playback of the source ended first."""
+    while duration - source.played_frames * FRAME_DURATION > seconds:
+        if source.closed:
+            return False
+        await asyncio.sleep(0.5)
+    return not source.closed
+
+async def prespawn_next(guild_id, queue, source, duration):
+    """Resolve next song early and start its FFmpeg shortly before current one ends"""
+    try:
+        # Remaining time is measured from played frames, so pauses don't move it forward
+        if not await wait_until_remaining(source, duration, PRESPAWN_RESOLVE_SECONDS):
+            return
+
+        song = peek_next_song(queue)
+        if not song:
+            return
+        # Fills stream_cache now, so the extraction is done by the time FFmpeg is spawned
+        info = await resolve_song(song)
+
+        if not await wait_until_remaining(source, duration, PRESPAWN_SECONDS):
+            return
+
+        if peek_next_song(queue) is not song:
+            song = peek_next_song(queue)
+            if not song:
+                return
+            info = await resolve_song(song)
+
+        stream_url = info.get('url') if info else None
+        if not stream_url or not stream_url.startswith('http'):
+            return
+
+        stale = prespawned.pop(guild_id, None)
+        if stale:
+            stale['source'].cleanup()
+
+        if len(prespawned) >= PRESPAWN_MAX:
+            print('⚠️ Pre-spawn limit reached, skipping')
+            return
+
+        prespawned[guild_id] = {'song': song, 'info': info, 'source': create_source(info)}
+        print(f'🚀 Pre-spawned FFmpeg for: {info.get("title", "Unknown song")}')
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f'⚠️ Pre-spawn error: {e}')
+    finally:
+        if prespawn_tasks.get(guild_id) is asyncio.current_task():
+            del prespawn_tasks[guild_id]
+
+FRAME_DURATION = 0.02  # discord.py sends one 20ms Opus frame per read
+# A single read blocking longer than this (FFmpeg connecting or reconnecting) is excused
+LONG_READ = 0.2
+
+class MonitoredSource(discord.AudioSource):
+    """Wraps audio source and measures how late the player asks for each frame"""
+
+    def __init__(self, original, voice_client):
+        self.original = original
+        self.voice_client = voice_client
+        self.started_at = None
+        self.last_read = None
+        self.frames = 0
+        self.played_frames = 0
+        self.closed = False
+        self.pending_bitrate = None
+        # Lag caused by slow FFmpeg reads, forgiven until the player catches up
+        self.excused = 0.0
+        self.anchor = None
+        # Lateness samples of current window, swapped out by take_lateness()
+        self.lock = threading.Lock()
+        self.samples = []
+
+    @property
+    def pid(self):
+        process = getattr(self.original, '_process', None)
+        return process.pid if process else None
+
+    def request_bitrate(self, bitrate):
+        """Change encoder bitrate before the next frame (applied in player thread)"""
+        with self.lock:
+            self.pending_bitrate = bitrate
+
+    def schedule(self, called):
+        """Return (start, loops) of the player's frame schedule for this read.
+
+        discord.py's AudioPlayer sets _start before the first read and resets it
+        (with loops = 0) on resume, then increments loops right before each read.
+        Without access to the player the same schedule is modelled here; a gap
+        between reads longer than LONG_READ is then taken as a pause/resume."""
+        player = getattr(self.voice_client, '_player', None)
+        start = getattr(player, '_start', None)
+        loops = getattr(player, 'loops', None)
+        if isinstance(start, float) and isinstance(loops, int) and loops > 0:
+            return start, loops
+
+        if self.last_read is None or called - self.last_read > LONG_READ:
+            # First frame or resumed after pause
+            self.started_at = called
+            self.frames = 0
+        self.frames += 1
+        return self.started_at, self.frames
+
+    def read(self):
+        # Runs in discord.py's player thread right before the frame is encoded,
+        # so the encoder can't be in use here
+        with self.lock:
+            bitrate, self.pending_bitrate = self.pending_bitrate, None
+        if bitrate:
+            encoder = getattr(self.voice_client, 'encoder', None)
+            if encoder:
+                encoder.set_bitrate(bitrate)
+
+        called = time.perf_counter()
+        start, loops = self.schedule(called)
+        if start != self.anchor:
+            self.anchor = start
+            self.excused = 0.0
+
+        # The player reads frame 1 at start, then sleeps until start + loops * DELAY
+        # for every following frame (so frames 1 and 2 are 2 * DELAY apart)
+        expected = start if loops == 1 else start + loops * FRAME_DURATION
+        lag = max(0.0, called - expected)
+        self.excused = min(self.excused, lag)
+        lateness = lag - self.excused
+
+        data = self.original.read()
+        now = time.perf_counter()
+
+        if now - called > LONG_READ:
+            # FFmpeg connecting or reconnecting: the player will burst to catch up,
+            # don't count the resulting lag as a missed deadline
+            self.excused += now - called
+
+        with self.lock:
+            self.samples.append(lateness)
+
+        self.played_frames += 1
+        self.last_read = now
+        return data
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.closed = True
+        self.original.cleanup()
+
+    def take_lateness(self):
+        """Return (average, 95th percentile, max) lateness in seconds since last call"""
+        with self.lock:
+            samples, self.samples = self.samples, []
+        if not samples:
+            return 0.0, 0.0, 0.0
+        samples.sort()
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        return sum(samples) / len(samples), p95, samples[-1]
+
+def read_process_stats(pid):
+    """Return (cpu_seconds, rss_bytes) of process from /proc, None if unavailable"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        utime, stime, rss_pages = int(fields[11]), int(fields[12]), int(fields[21])
+        return (utime + stime) / os.sysconf('SC_CLK_TCK'), rss_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class VoiceStats:
+    """Resource usage and quality level of one guild's voice session"""
+
+    def __init__(self):
+        self.source = None
+        self.bitrate_level = 0
+        self.healthy_samples = 0
+        self.cpu_percent = None
+        self.rss = None
+        self.late_avg = 0.0
+        self.late_p95 = 0.0
+        self.late_max = 0.0
+        self.cpu_time = None
+        self.sampled_at = None
+
+    @property
+    def bitrate(self):
+        return VOICE_BITRATES[self.bitrate_level]
+
+    def attach(self, source):
+        self.source = source
+        self.cpu_time = None
+        self.cpu_percent = None
+        self.rss = None
+
+    def sample(self):
+        self.late_avg, self.late_p95, self.late_max = self.source.take_lateness()
+
+        pid = self.source.pid
+        usage = read_process_stats(pid) if pid else None
+        if not usage:
+            return
+
+        now = time.monotonic()
+        cpu_time, self.rss = usage
+        if self.cpu_time is not None and now > self.sampled_at:
+            self.cpu_percent = (cpu_time - self.cpu_time) / (now - self.sampled_at) * 100
+        self.cpu_time = cpu_time
+        self.sampled_at = now
+
+voice_stats = {}
+# Set when frame deadlines slip badly, new voice sessions are refused
+voice_overloaded = False
+
+def get_voice_stats(guild_id):
+    if guild_id not in voice_stats:
+        voice_stats[guild_id] = VoiceStats()
+    return voice_stats[guild_id]
+
+def adapt_quality(stats, guild_id):
+    """Lower bitrate when frames are late, restore it after stable samples"""
+    late_ms = stats.late_p95 * 1000
+
+    if late_ms > LATENESS_DEGRADE_MS:
+        stats.healthy_samples = 0
+        if stats.bitrate_level < len(VOICE_BITRATES) - 1:
+            stats.bitrate_level += 1
+            stats.source.request_bitrate(stats.bitrate)
+            print(f'📉 Guild {guild_id}: frames {late_ms:.0f}ms late, bitrate -> {stats.bitrate}k')
+    elif late_ms < LATENESS_DEGRADE_MS / 2:
+        stats.healthy_samples += 1
+        if stats.bitrate_level > 0 and stats.healthy_samples >= 3:
+            stats.healthy_samples = 0
+            stats.bitrate_level -= 1
+            stats.source.request_bitrate(stats.bitrate)
+            print(f'📈 Guild {guild_id}: playback stable, bitrate -> {stats.bitrate}k')
+
+async def monitor_resources():
+    """Periodically sample FFmpeg usage and frame lateness of every guild"""
+    global voice_overloaded
+
+    while True:
+        await asyncio.sleep(RESOURCE_SAMPLE_INTERVAL)
+        try:
+            worst_ms = 0.0
+            for guild_id, stats in list(voice_stats.items()):
+                guild = bot.get_guild(guild_id)
+                voice_client = guild.voice_client if guild else None
+                if not voice_client or not voice_client.is_playing() or voice_client.source is not stats.source:
+                    continue
+
+                stats.sample()
+                worst_ms = max(worst_ms, stats.late_p95 * 1000)
+                if ADAPTIVE_QUALITY:
+                    adapt_quality(stats, guild_id)
+
+            overloaded = ADAPTIVE_QUALITY and worst_ms > LATENESS_REFUSE_MS
+            if overloaded != voice_overloaded:
+                voice_overloaded = overloaded
+                if overloaded:
+                    print(f'🔥 Overloaded (frames {worst_ms:.0f}ms late), refusing new voice sessions')
+                else:
+                    print('✅ Load back to normal, accepting new voice sessions')
+        except Exception as e:
+            print(f'⚠️ Resource monitor error: {e}')
+
 async def play_next(ctx):
     """Play next song from queue"""
     queue = get_queue(ctx.guild.id)
 
     if queue.is_empty() and not queue.loop:
+        discard_prespawned(ctx.guild.id)
         now_playing[ctx.guild.id] = None
         await ctx.send("✅ Queue is empty! Use `!play <song>` to add music", silent=True)
         return
@@ -441,22 +1179,26 @@ async def play_next(ctx):
         return
 
     voice_client = ctx.guild.voice_client
+    # FFmpeg source not yet handed to voice_client.play, killed on every early exit
+    pending_source = None
 
     try:
-        # Get fresh stream URL before playback
-        if 'url' in song:
-            info = await extract_info_async(song['url'], YDL_OPTIONS)
+        ready = take_prespawned(ctx.guild.id, song)
+
+        # Get stream URL (shared cache keeps it until shortly before expiry)
+        if ready:
+            pending_source = ready['source']
+            info = ready['info']
         else:
-            info = await extract_info_async(song['search'], YDL_OPTIONS)
-            if 'entries' in info:
-                info = info['entries'][0]
+            info = await resolve_song(song)
+
+        if not info:
+            raise Exception('Nothing found')
 
         stream_url = info.get('url')
         webpage_url = info.get('webpage_url', info.get('original_url', 'N/A'))
         title = info.get('title', 'Unknown song')
 
-        http_headers = info.get('http_headers', {})
-
         print(f'🔍 Webpage: {webpage_url}')
         print(f'🔍 Stream URL (first 80 chars): {stream_url[:80] if stream_url else "None"}...')
 
@@ -487,43 +1229,44 @@ async def play_next(ctx):
             await ctx.send('❌ Bot not connected to voice channel!', silent=True)
             return
 
-        ffmpeg_before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
-
-        if http_headers:
-            user_agent = http_headers.get('User-Agent', '')
-            if user_agent:
-                ffmpeg_before_options += f' -user_agent "{user_agent}"'
-
-        ffmpeg_before_options += ' -headers "Referer: https://www.youtube.com/"'
-
-        print(f'🔧 FFmpeg options: {ffmpeg_before_options}')
-
-        source = discord.FFmpegPCMAudio(
-            stream_url,
-            executable=FFMPEG_PATH,
-            before_options=ffmpeg_before_options + ' -analyzeduration 0 -probesize 32',
-            options='-vn -f s16le -ar 48000 -ac 2 -bufsize 512k'
-        )
-
-        print(f'🎵 Source created, starting playback...')
+        if ready:
+            print(f'🚀 Using pre-spawned FFmpeg, starting playback...')
+        else:
+            pending_source = create_source(info)
+            print(f'🎵 Source created, starting playback...')
 
+        stats = get_voice_stats(ctx.guild.id)
+        source = MonitoredSource(pending_source, voice_client)
+        source.request_bitrate(stats.bitrate)
         voice_client.play(source, after=after_playing)
+        pending_source = None
+        stats.attach(source)
 
         print(f'▶️ Playback started')
+
+        duration = info.get('duration')
+        if PRESPAWN_FFMPEG and duration:
+            prespawn_tasks[ctx.guild.id] = bot.loop.create_task(
+                prespawn_next(ctx.guild.id, queue, source, duration)
+            )
         await ctx.send(f'🎵 Now playing: **{title}**', silent=True)
 
     except Exception as e:
         print(f'❌ CRITICAL ERROR: {e}')
         print(f'Type: {type(e).__name__}')
-        import traceback
         traceback.print_exc()
         await ctx.send(f'❌ Playback error: {str(e)}', silent=True)
         asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+    finally:
+        if pending_source:
+            pending_source.cleanup()
 
 @bot.event
 async def on_ready():
     print(f'🎵 {bot.user} online!')
     print(f'Prefix: !')
+    if PROFILE_IMPORTS:
+        print(f'⏱️ Startup to on_ready: {time.perf_counter() - STARTUP_TIME:.2f}s')
 
     try:
         import nacl
@@ -531,6 +1274,15 @@ async def on_ready():
     except ImportError:
         print('❌ WARNING: PyNaCl not installed! Run: pip install PyNaCl')
 
+    # on_ready fires again after reconnects, start background tasks only once
+    global warmup_task, monitor_task, search_cache_task
+    if warmup_task is None:
+        warmup_task = bot.loop.create_task(warm_up_extractor())
+    if search_cache_task is None and search_cache.path:
+        search_cache_task = bot.loop.create_task(flush_search_cache())
+    if monitor_task is None:
+        monitor_task = bot.loop.create_task(monitor_resources())
+
     print('Ready to play music!')
 
 @bot.event
@@ -539,15 +1291,17 @@ async def on_message(message):
     if message.author == bot.user:
         return
 
-    music_link = find_music_link(message.content)
+    ctx = await bot.get_context(message)
+
+    # Commands handle their own links
+    music_links = [] if ctx.valid else find_music_links(message.content)
 
-    if music_link:
-        print(f'🔗 Found link: {music_link}')
+    if music_links:
+        print(f'🔗 Found {len(music_links)} link(s): {", ".join(music_links)}')
         print(f'👤 From user: {message.author}')
 
         if message.author.voice:
-            ctx = await bot.get_context(message)
-            await ctx.invoke(bot.get_command('play'), query=music_link)
+            await ctx.invoke(bot.get_command('play'), query=' '.join(music_links))
         else:
             await message.channel.send('❌ Join a voice channel to play music!', silent=True)
 
@@ -563,6 +1317,10 @@ async def play(ctx, *, query):
 
     voice_channel = ctx.author.voice.channel
 
+    if not ctx.guild.voice_client and voice_overloaded:
+        await ctx.send('⚠️ Bot is overloaded right now, try again in a minute!', silent=True)
+        return
+
     if not ctx.guild.voice_client:
         await voice_channel.connect()
     elif ctx.guild.voice_client.channel != voice_channel:
@@ -570,95 +1328,49 @@ async def play(ctx, *, query):
 
     queue = get_queue(ctx.guild.id)
 
-    # Handle Spotify links
-    if is_spotify_link(query):
-        # Spotify albums
-        if is_spotify_album(query):
-            await ctx.send(f'💿 Spotify album detected, loading tracks...', silent=True)
-
-            album_match = re.search(r'album/([a-zA-Z0-9]+)', query)
-            if not album_match:
-                await ctx.send('❌ Failed to extract album ID!', silent=True)
-                return
-
-            album_id = album_match.group(1)
-
-            tracks = await get_spotify_album_tracks(album_id)
-
-            if not tracks:
-                await ctx.send('❌ Failed to get album tracks!', silent=True)
-                return
-
-            await ctx.send(f'✅ Found **{len(tracks)}** tracks. Adding to queue...', silent=True)
-
-            for track in tracks:
-                queue.add({'search': f'ytsearch:{track}'})
-
-            await ctx.send(f'✅ Added **{len(tracks)}** tracks to queue!', silent=True)
-
-            if not ctx.guild.voice_client.is_playing():
-                await play_next(ctx)
+    # Several links in one message are queued as one batch
+    links = find_music_links(query)
+    if len(links) > 1:
+        await enqueue_batch(ctx, queue, links)
+        return
 
+    # Single YouTube/Spotify link (or any other URL yt-dlp can handle)
+    if links or query.startswith('http'):
+        link = links[0] if links else query.strip()
+        try:
+            songs = await resolve_link(link, notify=lambda text: ctx.send(text, silent=True))
+        except Exception as e:
+            await ctx.send(f'❌ Error: {str(e)}', silent=True)
             return
 
-        # Spotify playlists (not supported)
-        if is_spotify_playlist(query):
-            await ctx.send('⚠️ **Spotify playlists not supported due to API limitations.**\n\n💡 But you can:\n• Use Spotify **albums** (they work!)\n• Add individual **tracks** from Spotify\n• Use YouTube playlists', silent=True)
+        if not songs:
             return
 
-        # Spotify tracks
-        await ctx.send(f'🎧 Spotify link detected, converting to YouTube...', silent=True)
-        search_query = await convert_spotify_to_youtube(query)
+        for song in songs:
+            queue.add(song)
 
-        if not search_query:
-            await ctx.send('❌ Failed to get info from Spotify!', silent=True)
-            return
-
-        await ctx.send(f'🔍 Searching on YouTube: **{search_query}**...', silent=True)
-
-        try:
-            info = await extract_info_async(f'ytsearch:{search_query}', YDL_OPTIONS)
-            if 'entries' in info and len(info['entries']) > 0:
-                video = info['entries'][0]
-                queue.add({'search': f'ytsearch:{search_query}'})
-                await ctx.send(f'✅ Added to queue: **{video.get("title", search_query)}**', silent=True)
-            else:
-                await ctx.send('❌ Nothing found on YouTube!', silent=True)
-                return
-        except Exception as e:
-            await ctx.send(f'❌ Error: {str(e)}', silent=True)
-            return
+        if len(songs) == 1:
+            song_name = songs[0].get('title') or songs[0].get('search', link)
+            await ctx.send(f'✅ Added to queue: **{song_name}**', silent=True)
+        else:
+            await ctx.send(f'✅ Added **{len(songs)}** tracks to queue!', silent=True)
 
         if not ctx.guild.voice_client.is_playing():
             await play_next(ctx)
 
         return
 
-    # Handle YouTube links and search
+    # YouTube search
     await ctx.send(f'🔍 Searching: **{query}**...', silent=True)
 
     try:
-        if query.startswith('http'):
-            info = await extract_info_async(query, YDL_OPTIONS)
-
-            # YouTube playlists
-            if 'entries' in info:
-                await ctx.send(f'📝 Adding playlist: **{info.get("title", "Playlist")}** ({len(info["entries"])} songs)', silent=True)
-                for entry in info['entries']:
-                    queue.add({'url': entry['url']})
-            else:
-                queue.add({'url': query})
-                await ctx.send(f'✅ Added to queue: **{info.get("title", query)}**', silent=True)
+        song = await search_song(query)
+        if song:
+            queue.add(song)
+            await ctx.send(f'✅ Added to queue: **{song["title"]}**', silent=True)
         else:
-            # YouTube search
-            info = await extract_info_async(f'ytsearch:{query}', YDL_OPTIONS)
-            if 'entries' in info and len(info['entries']) > 0:
-                video = info['entries'][0]
-                queue.add({'search': f'ytsearch:{query}'})
-                await ctx.send(f'✅ Added to queue: **{video.get("title", query)}**', silent=True)
-            else:
-                await ctx.send('❌ Nothing found!', silent=True)
-                return
+            await ctx.send('❌ Nothing found!', silent=True)
+            return
 
         if not ctx.guild.voice_client.is_playing():
             await play_next(ctx)
@@ -698,6 +1410,7 @@ async def stop(ctx):
     """Stop music and clear queue"""
     queue = get_queue(ctx.guild.id)
     queue.clear()
+    discard_prespawned(ctx.guild.id)
 
     if ctx.guild.voice_client:
         ctx.guild.voice_client.stop()
@@ -711,6 +1424,8 @@ async def leave(ctx):
     if ctx.guild.voice_client:
         await ctx.guild.voice_client.disconnect()
         get_queue(ctx.guild.id).clear()
+        discard_prespawned(ctx.guild.id)
+        voice_stats.pop(ctx.guild.id, None)
     else:
         await ctx.send('❌ Bot not connected!', silent=True)
 
@@ -731,7 +1446,7 @@ async def queue_command(ctx):
     if not queue.is_empty():
         message += '**Up next:**\n'
         for i, song in enumerate(list(queue.queue)[:10], 1):
-            song_name = song.get('url', song.get('search', 'Unknown song'))
+            song_name = song.get('title') or song.get('url', song.get('search', 'Unknown song'))
             message += f'{i}. {song_name}\n'
 
         if len(queue.queue) > 10:
@@ -758,6 +1473,31 @@ async def now_playing_command(ctx):
     else:
         await ctx.send('❌ Nothing is playing!', silent=True)
 
+@bot.command(name='resources', aliases=['stats'])
+async def resources_command(ctx):
+    """Show FFmpeg and voice resource usage"""
+    message = '📊 **Resources:**\n\n'
+
+    usage = read_process_stats(os.getpid())
+    if usage:
+        message += f'🤖 Bot process: {usage[1] / 1024 / 1024:.0f} MB RSS\n'
+    message += f'🔊 Voice sessions: {len(bot.voice_clients)}, pre-spawned FFmpeg: {len(prespawned)}\n'
+    if voice_overloaded:
+        message += '🔥 Overloaded: new voice sessions are refused\n'
+    message += '\n'
+
+    stats = voice_stats.get(ctx.guild.id)
+    if stats and stats.source:
+        cpu = f'{stats.cpu_percent:.1f}%' if stats.cpu_percent is not None else 'n/a'
+        rss = f'{stats.rss / 1024 / 1024:.0f} MB' if stats.rss is not None else 'n/a'
+        message += f'**This server:**\nFFmpeg CPU: {cpu}, RSS: {rss}\n'
+        message += f'Frame lateness: avg {stats.late_avg * 1000:.1f}ms, p95 {stats.late_p95 * 1000:.1f}ms, max {stats.late_max * 1000:.1f}ms\n'
+        message += f'Bitrate: {stats.bitrate}k'
+    else:
+        message += 'Nothing is playing on this server'
+
+    await ctx.send(message, silent=True)
+
 @bot.command(name='help_music', aliases=['commands'])
 async def help_music(ctx):
     """Show all commands"""
@@ -777,11 +1517,15 @@ async def help_music(ctx):
 `!np` - Now playing
 `!loop` - Toggle loop for current song
 
+**Info:**
+`!resources` - Show FFmpeg CPU/memory and playback stats
+
 **Support:**
 - YouTube links and search
 - Spotify tracks (auto-search on YouTube)
 - Spotify albums (all tracks added to queue)
 - YouTube playlists
+- Several links in one message (added as one batch)
 
 **Note:** Spotify playlists not supported due to API limitations
     """
@@ -790,5 +1534,7 @@ async def help_music(ctx):
 if __name__ == '__main__':
     if TOKEN:
         bot.run(TOKEN)
+        if search_cache.dirty:
+            search_cache.save()
     else:
         print('❌ ERROR: Token not found! Create .env file')